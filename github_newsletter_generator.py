@@ -1,23 +1,148 @@
+import atexit
+import functools
+import hashlib
 import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from anthropic import Anthropic
-from typing import List, Dict
+from typing import List, Dict, Optional, TextIO, Tuple
 import json
+import orjson
 from dotenv import load_dotenv
 
+load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
+
+GITHUB_GRAPHQL_URL = 'https://api.github.com/graphql'
+# Times a rate-limited GitHub request is re-sent after waiting, and the fallback wait when GitHub gives no hint
+RATE_LIMIT_MAX_WAITS = 3
+RATE_LIMIT_DEFAULT_WAIT = 60
+GITHUB_CACHE_PATH = os.path.join(os.path.dirname(__file__), '.github_cache.json')
+# GraphQL POSTs can't be revalidated with ETags, so their cached responses simply expire
+GRAPHQL_CACHE_TTL = 3600
+
+# Fetch the top repositories, meilisearch-cloud and their latest releases in a single round-trip
+REPOS_AND_RELEASES_QUERY = """
+query($org: String!) {
+  organization(login: $org) {
+    cloud: repository(name: "meilisearch-cloud") {
+      ...repoFields
+    }
+    repositories(first: 20, isFork: false, orderBy: {field: PUSHED_AT, direction: DESC}) {
+      nodes {
+        ...repoFields
+      }
+    }
+  }
+}
+
+fragment repoFields on Repository {
+  name
+  nameWithOwner
+  stargazerCount
+  forkCount
+  releases(first: 30, orderBy: {field: CREATED_AT, direction: DESC}) {
+    pageInfo {
+      hasNextPage
+    }
+    nodes {
+      name
+      tagName
+      publishedAt
+      description
+    }
+  }
+}
+"""
+
+# Release note noise that costs prompt tokens without informing the analysis
+IMAGE_PATTERN = re.compile(r'!\[[^\]]*\]\([^)]*\)|<img[^>]*>', re.IGNORECASE)
+HTML_COMMENT_PATTERN = re.compile(r'<!--.*?-->', re.DOTALL)
+TRAILING_WHITESPACE_PATTERN = re.compile(r'[ \t]+$', re.MULTILINE)
+BLANK_LINES_PATTERN = re.compile(r'\n{3,}')
+
+# Per-release prompt budget, estimated at ~4 characters per token for English Markdown
+RELEASE_NOTES_TOKEN_BUDGET = 400
+CHARS_PER_TOKEN = 4
+
+# Seconds between Message Batch status checks
+BATCH_POLL_INTERVAL = 30
+
+# Static prompt blocks, sent ahead of the per-run content
+ANALYSIS_SYSTEM_PROMPT = "You are a Product Marketing expert for Meilisearch, focused on communicating the value of our open-source search engine to developers."
+
+ANALYSIS_INSTRUCTIONS = """You are a Product Marketing expert for Meilisearch.
+
+Context about Meilisearch:
+- Meilisearch is an open-source search engine (meilisearch/meilisearch repository)
+- The core product is used by developers to add search functionality to their applications
+- Focus on changes that affect developers using Meilisearch in their projects
+- Internal cloud platform changes (from meilisearch-cloud repository) should be ignored
+
+Please analyze the releases below and identify the most significant improvements or changes 
+that would be valuable to highlight to developers using Meilisearch. Focus on:
+- New features in the core search engine
+- Performance improvements
+- API changes or additions
+- SDK updates that make integration easier
+- Breaking changes that developers need to know about
+
+Ignore:
+- Internal cloud platform changes
+- Administrative or operational updates
+- Changes that don't affect the developer experience
+
+Please provide your analysis in a structured format with:
+1. A brief summary of each important change
+2. Why it matters to developers
+3. Order them by importance from a developer's perspective
+"""
+
+NEWSLETTER_SYSTEM_PROMPT = "You are a Product Marketing expert for Meilisearch, skilled at communicating technical improvements to developers using our open-source search engine."
+
+NEWSLETTER_INSTRUCTIONS = """Based on the analysis below of Meilisearch's {year} releases, 
+please write an engaging newsletter for developers using Meilisearch in their projects.
+
+The newsletter should:
+1. Have an attention-grabbing introduction focused on developer benefits
+2. Highlight the most important improvements to the core search engine
+3. Include relevant technical details that developers need to know
+4. Explain any breaking changes and migration steps
+5. End with a call to action (e.g., try new features, upgrade version)
+
+Focus on:
+- Changes that affect developers using Meilisearch
+- Technical improvements and new capabilities
+- SDK updates and API changes
+
+Avoid mentioning:
+- Internal cloud platform changes
+- Administrative or operational updates
+- Changes that don't affect developers
+
+Format the response in Markdown with:
+- A clear technical subject line
+- Preview text highlighting key improvements
+- Proper headers (##) for each section
+- Code examples where relevant
+- Bullet points for features
+- Bold and italic text for emphasis
+"""
+
 class NewsletterGenerator:
     def __init__(self):
-        env_path = os.path.join(os.path.dirname(__file__), '.env')
-        print(f"Loading .env from: {env_path}")
-        load_dotenv(env_path)
-        
         # Load Anthropic key
         self.anthropic_key = os.getenv('ANTHROPIC_API_KEY')
-        print(f"Raw API key from env: {self.anthropic_key}")
-        if not self.anthropic_key or self.anthropic_key.startswith('your_') or not self.anthropic_key.startswith('sk-ant-'):
+        if not self.anthropic_key or not self.anthropic_key.startswith('sk-ant-'):
             raise ValueError("Please set a valid ANTHROPIC_API_KEY in your .env file")
-        print(f"API key prefix: {self.anthropic_key[:15]}...")
+        if os.getenv('DEBUG'):
+            print(f"Using Anthropic API key {self.anthropic_key[:8]}…")
         
         # Load GitHub token
         self.github_token = os.getenv('GITHUB_TOKEN')
@@ -28,43 +153,149 @@ class NewsletterGenerator:
             'Authorization': f'token {self.github_token}',
             'Accept': 'application/vnd.github.v3+json'
         }
+        # Reuse one pooled, keep-alive session for every GitHub API call
+        self.session = requests.Session()
+        self.session.headers.update(self.github_headers)
+        adapter = HTTPAdapter(
+            pool_connections=20,
+            pool_maxsize=20,
+            max_retries=Retry(
+                total=5,
+                backoff_factor=0.5,
+                # 403/429 rate limits can last longer than urllib3's backoff; _github_request waits those out
+                status_forcelist=[502, 503, 504],
+                allowed_methods=['GET', 'POST'],  # The GraphQL POST is a read-only query
+                respect_retry_after_header=True
+            )
+        )
+        self.session.mount('https://', adapter)
+        
+        # Conditional request cache (URL -> validators + JSON body), persisted across runs
+        self._cache_lock = threading.Lock()
+        self._etag_cache = self._load_etag_cache()
+        
         self.anthropic_client = Anthropic(api_key=self.anthropic_key)
+    
+    def close(self):
+        """Persist the GitHub response cache and release the pooled connections"""
+        self._save_etag_cache()
+        self.session.close()
+    
+    def _load_etag_cache(self) -> Dict[str, Dict]:
+        """Load cached GitHub responses from a previous run"""
+        try:
+            with open(GITHUB_CACHE_PATH) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def _save_etag_cache(self):
+        """Write cached GitHub responses to disk"""
+        with self._cache_lock:
+            try:
+                with open(GITHUB_CACHE_PATH, 'w') as f:
+                    json.dump(self._etag_cache, f)
+            except OSError as e:
+                print(f"Warning: Could not save GitHub cache: {e}")
+    
+    def _github_get_page(self, url: str) -> Tuple[object, Optional[str]]:
+        """GET one page of a GitHub REST resource, returning its body and the next page URL.
+        The cached body is reused when GitHub answers 304 Not Modified."""
+        with self._cache_lock:
+            cached = self._etag_cache.get(url)
+        
+        headers = {}
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        
+        response = self._github_request('GET', url, headers=headers)
+        if response.status_code == 304 and cached:
+            return cached['data'], cached.get('next')
+        response.raise_for_status()
+        
+        data = response.json()
+        next_url = response.links.get('next', {}).get('url')
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            with self._cache_lock:
+                self._etag_cache[url] = {'etag': etag, 'last_modified': last_modified, 'data': data, 'next': next_url}
+        return data, next_url
+    
+    def _graphql_query(self, query: str, variables: Dict) -> Dict:
+        """POST a GitHub GraphQL query, reusing a cached response younger than GRAPHQL_CACHE_TTL"""
+        body = {'query': query, 'variables': variables}
+        cache_key = 'graphql:' + hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest()
+        with self._cache_lock:
+            cached = self._etag_cache.get(cache_key)
+        if cached and time.time() - cached['fetched_at'] < GRAPHQL_CACHE_TTL:
+            return cached['data']
+        
+        response = self._github_request('POST', GITHUB_GRAPHQL_URL, json=body)
+        response.raise_for_status()
+        
+        payload = response.json()
+        # Only cache answers that carry data; error-only payloads should be retried next run
+        if payload.get('data'):
+            with self._cache_lock:
+                self._etag_cache[cache_key] = {'fetched_at': time.time(), 'data': payload}
+        return payload
+    
+    def _github_request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Send a GitHub API request, waiting out rate limits and re-sending it a bounded number of times"""
+        for attempt in range(RATE_LIMIT_MAX_WAITS + 1):
+            response = self.session.request(method, url, **kwargs)
+            delay = self._rate_limit_delay(response)
+            if delay is None or attempt == RATE_LIMIT_MAX_WAITS:
+                return response
+            print(f"GitHub rate limit reached, retrying in {delay:.0f}s...")
+            time.sleep(delay)
+        
+    def _rate_limit_delay(self, response: requests.Response) -> Optional[float]:
+        """Seconds to wait before re-sending a rate-limited request, or None if it was not rate limited"""
+        if response.status_code not in (403, 429):
+            return None
+        
+        retry_after = response.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return int(retry_after)
+        if response.headers.get('X-RateLimit-Remaining') == '0':
+            reset_at = int(response.headers.get('X-RateLimit-Reset', '0'))
+            return max(reset_at - time.time(), 0) + 1
+        # GitHub asks to wait at least a minute on secondary rate limits, which can come without headers
+        if response.status_code == 429 or 'secondary rate limit' in response.text.lower():
+            return RATE_LIMIT_DEFAULT_WAIT
+        # Any other 403 is a permission or credentials problem, retrying won't help
+        return None
         
     def get_active_repositories(self, org: str, limit: int = 5) -> List[Dict]:
-        """Fetch the most active repositories for an organization"""
-        url = f'https://api.github.com/orgs/{org}/repos'
-        repos = []
+        """Fetch the most recently pushed repositories for an organization"""
+        # GitHub sorts by latest push server-side, so the first page already holds the most active repositories
+        url = f'https://api.github.com/orgs/{org}/repos?per_page=100&sort=pushed&direction=desc&type=sources'
+        cloud_repo = None
+        other_repos = []
         
         try:
-            response = requests.get(url, headers=self.github_headers)
-            response.raise_for_status()
-            
-            all_repos = response.json()
+            # Walk further pages while we are short of repositories or haven't seen meilisearch-cloud
+            while url and (cloud_repo is None or len(other_repos) + 1 < limit):
+                page, url = self._github_get_page(url)
+                for repo in page:
+                    if repo['name'] == 'meilisearch-cloud':
+                        cloud_repo = repo
+                    else:
+                        other_repos.append(repo)
             
-            # First, try to get meilisearch-cloud directly
-            cloud_repo_url = f'https://api.github.com/repos/{org}/meilisearch-cloud'
-            try:
-                cloud_response = requests.get(cloud_repo_url, headers=self.github_headers)
-                cloud_response.raise_for_status()
-                cloud_repo = cloud_response.json()
+            # meilisearch-cloud goes first, followed by other repositories up to the limit
+            repos = []
+            if cloud_repo:
                 repos.append(cloud_repo)
                 print(f"Added meilisearch-cloud repository")
-            except requests.exceptions.RequestException as e:
-                print(f"Warning: Could not fetch meilisearch-cloud: {e}")
-            
-            # Sort remaining repositories by activity
-            sorted_repos = sorted(
-                all_repos,
-                key=lambda x: x['stargazers_count'] + x['forks_count'] + x['watchers_count'],
-                reverse=True
-            )
-            
-            # Add other repositories up to the limit
-            for repo in sorted_repos:
-                if repo['name'] != 'meilisearch-cloud':  # Skip if already added
-                    repos.append(repo)
-                    if len(repos) >= limit:
-                        break
+            else:
+                print(f"Warning: meilisearch-cloud is not listed in the {org} repositories")
+            repos.extend(other_repos[:limit - len(repos)])
             
             return repos
             
@@ -72,172 +303,352 @@ class NewsletterGenerator:
             print(f"Error fetching repositories: {e}")
             return []
 
+    def get_repos_and_releases_graphql(self, org: str, year: int = 2024, limit: int = 5) -> Tuple[List[Dict], Dict[str, List[Dict]]]:
+        """Fetch the most active repositories and their releases in the specified year with one GraphQL query"""
+        try:
+            payload = self._graphql_query(REPOS_AND_RELEASES_QUERY, {'org': org})
+            organization = (payload.get('data') or {}).get('organization')
+            if not organization:
+                print(f"Error fetching repositories with GraphQL: {payload.get('errors')}")
+                return [], {}
+            
+            # meilisearch-cloud goes first, followed by the most recently pushed repositories
+            nodes = []
+            if organization.get('cloud'):
+                nodes.append(organization['cloud'])
+                print(f"Added meilisearch-cloud repository")
+            for node in organization['repositories']['nodes']:
+                if node['name'] != 'meilisearch-cloud':  # Skip if already added
+                    nodes.append(node)
+                    if len(nodes) >= limit:
+                        break
+            
+            # Map the GraphQL nodes onto the REST field names used by the rest of the pipeline
+            repos = []
+            releases_by_repo = {}
+            incomplete_repos = []
+            for node in nodes:
+                full_name = node['nameWithOwner']
+                repos.append({
+                    'name': node['name'],
+                    'full_name': full_name,
+                    'stargazers_count': node['stargazerCount'],
+                    'forks_count': node['forkCount']
+                })
+                all_releases = [
+                    {
+                        'name': release.get('name') or '',
+                        'tag_name': release['tagName'],
+                        'published_at': release.get('publishedAt'),
+                        'body': release.get('description') or ''
+                    }
+                    for release in node['releases']['nodes']
+                ]
+                # The newest 30 releases may not reach back to the target year (e.g. backfills):
+                # page through the full history over REST for those repositories
+                if node['releases']['pageInfo']['hasNextPage'] and not self._reaches_before(all_releases, year):
+                    incomplete_repos.append(full_name)
+                else:
+                    releases_by_repo[full_name] = self._filter_releases(full_name, all_releases, year)
+            
+            releases_by_repo.update(self._get_releases_concurrently(incomplete_repos, year))
+            return repos, releases_by_repo
+            
+        except requests.exceptions.RequestException as e:
+            print(f"Error fetching repositories with GraphQL: {e}")
+            return [], {}
+
     def get_releases(self, repo_full_name: str, year: int = 2024) -> List[Dict]:
         """Fetch all releases for a repository in the specified year"""
-        url = f'https://api.github.com/repos/{repo_full_name}/releases'
-        releases = []
+        url = f'https://api.github.com/repos/{repo_full_name}/releases?per_page=100'
+        all_releases = []
         
         try:
-            response = requests.get(url, headers=self.github_headers)
-            response.raise_for_status()
-            
-            all_releases = response.json()
-            
-            for release in all_releases:
-                if not release.get('published_at'):
-                    continue
-                    
-                published_date = datetime.strptime(release['published_at'], '%Y-%m-%dT%H:%M:%SZ')
-                if published_date.year != year:
-                    continue
-                    
-                # For meilisearch/meilisearch, only include major and minor releases
-                if repo_full_name == 'meilisearch/meilisearch':
-                    tag = release['tag_name'].lstrip('v')
-                    # Skip if it's a patch release (e.g., v1.2.3 -> skip, v1.2.0 -> include)
-                    if tag.count('.') == 2 and not tag.endswith('.0'):
-                        continue
-                
-                releases.append(release)
+            # Releases are listed newest first: stop once a page reaches before the target year
+            while url:
+                page, url = self._github_get_page(url)
+                all_releases.extend(page)
+                if self._reaches_before(page, year):
+                    break
             
-            return releases
+            return self._filter_releases(repo_full_name, all_releases, year)
                 
         except requests.exceptions.RequestException as e:
             print(f"Error fetching releases for {repo_full_name}: {e}")
             return []
 
-    def analyze_releases(self, releases: List[Dict]) -> str:
-        """Use Claude to analyze releases and identify important changes"""
-        simplified_releases = []
-        for release in releases:
-            simplified_release = {
-                'name': release.get('name', ''),
-                'tag_name': release.get('tag_name', ''),
-                'published_at': release.get('published_at', ''),
-                'body': release.get('body', '')[:2000],  # Limit release notes to 2000 characters
-                'repository': release['url'].split('/repos/')[1].split('/releases')[0]
-            }
-            simplified_releases.append(simplified_release)
-        
-        # Take only the 10 most recent releases if there are more
-        if len(simplified_releases) > 10:
-            simplified_releases = simplified_releases[:10]
-        
-        releases_content = json.dumps(simplified_releases, indent=2)
-        
-        prompt = f"""You are a Product Marketing expert for Meilisearch.
-        
-        Context about Meilisearch:
-        - Meilisearch is an open-source search engine (meilisearch/meilisearch repository)
-        - The core product is used by developers to add search functionality to their applications
-        - Focus on changes that affect developers using Meilisearch in their projects
-        - Internal cloud platform changes (from meilisearch-cloud repository) should be ignored
-        
-        Please analyze these releases and identify the most significant improvements or changes 
-        that would be valuable to highlight to developers using Meilisearch. Focus on:
-        - New features in the core search engine
-        - Performance improvements
-        - API changes or additions
-        - SDK updates that make integration easier
-        - Breaking changes that developers need to know about
-        
-        Ignore:
-        - Internal cloud platform changes
-        - Administrative or operational updates
-        - Changes that don't affect the developer experience
-        
-        Here are the releases to analyze:
-        {releases_content}
+    def _reaches_before(self, releases: List[Dict], year: int) -> bool:
+        """Whether any of the releases was published before the specified year"""
+        year_prefix = str(year)
+        return any(release['published_at'][:4] < year_prefix for release in releases if release.get('published_at'))
+
+    def _filter_releases(self, repo_full_name: str, all_releases: List[Dict], year: int) -> List[Dict]:
+        """Keep the published releases from the specified year"""
+        releases = []
+        year_prefix = str(year)
+        for release in all_releases:
+            # published_at is ISO 8601, so the year check is a prefix comparison
+            published_at = release.get('published_at')
+            if not published_at or published_at[:4] != year_prefix:
+                continue
+                
+            # For meilisearch/meilisearch, only include major and minor releases
+            if repo_full_name == 'meilisearch/meilisearch':
+                tag = release['tag_name'].lstrip('v')
+                # Skip if it's a patch release (e.g., v1.2.3 -> skip, v1.2.0 -> include)
+                if tag.count('.') == 2 and not tag.endswith('.0'):
+                    continue
+            
+            # Copy so the cached GitHub payloads are not modified
+            releases.append({**release, 'repository': repo_full_name})
         
-        Please provide your analysis in a structured format with:
-        1. A brief summary of each important change
-        2. Why it matters to developers
-        3. Order them by importance from a developer's perspective
-        """
+        return releases
+
+    def collect_releases(self, org: str, year: int = 2024) -> Tuple[List[Dict], Dict[str, List[Dict]]]:
+        """Fetch the most active repositories and their releases, preferring GraphQL over REST"""
+        repos, releases_by_repo = self.get_repos_and_releases_graphql(org, year)
+        if repos:
+            return repos, releases_by_repo
         
+        print("Falling back to the REST API...")
+        repos = self.get_active_repositories(org)
+        return repos, self._get_releases_concurrently([repo['full_name'] for repo in repos], year)
+
+    def _get_releases_concurrently(self, repo_full_names: List[str], year: int) -> Dict[str, List[Dict]]:
+        """Fetch releases for several repositories concurrently over the shared session"""
+        releases_by_repo = {}
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = {executor.submit(self.get_releases, full_name, year): full_name for full_name in repo_full_names}
+            for future in as_completed(futures):
+                releases_by_repo[futures[future]] = future.result()
+        return releases_by_repo
+
+    def analyze_releases(self, releases: List[Dict]) -> str:
+        """Use Claude to analyze releases and identify important changes"""
         try:
-            response = self.anthropic_client.beta.messages.create(
-                model="claude-3-sonnet-20240229",
-                max_tokens=1000,
-                temperature=0,
-                system="You are a Product Marketing expert for Meilisearch, focused on communicating the value of our open-source search engine to developers.",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ]
-            )
+            response = self.anthropic_client.messages.create(**self._analysis_request(releases))
             
             print(f"Analysis response type: {type(response.content)}")
-            return response.content.text if hasattr(response.content, 'text') else str(response.content)
+            return self._response_text(response)
             
         except Exception as e:
             print(f"Error analyzing releases with Claude: {e}")
             return ""
 
-    def generate_newsletter(self, analysis: str) -> str:
-        """Generate the final newsletter content using Claude"""
-        prompt = f"""Based on this analysis of Meilisearch's 2024 releases, 
-        please write an engaging newsletter for developers using Meilisearch in their projects.
+    def generate_newsletter(self, analysis: str, year: int = 2024, output: Optional[TextIO] = None) -> str:
+        """Generate the final newsletter content using Claude, writing it to output as it streams in"""
+        try:
+            # Stream the response so output receives the newsletter as soon as Claude starts writing it
+            with self.anthropic_client.messages.stream(**self._newsletter_request(analysis, year)) as stream:
+                if output:
+                    for text in stream.text_stream:
+                        output.write(text)
+                return stream.get_final_text()
+            
+        except Exception as e:
+            print(f"Error generating newsletter with Claude: {e}")
+            return ""
+
+    def generate_newsletters_batch(self, years: List[int]) -> Dict[int, str]:
+        """Generate Meilisearch newsletters for several years through the discounted Message Batches API"""
+        # The prompts and repository filters are Meilisearch-specific, so jobs only vary by year
+        job_ids = {f'meilisearch-{year}': year for year in years}
         
-        The newsletter should:
-        1. Have an attention-grabbing introduction focused on developer benefits
-        2. Highlight the most important improvements to the core search engine
-        3. Include relevant technical details that developers need to know
-        4. Explain any breaking changes and migration steps
-        5. End with a call to action (e.g., try new features, upgrade version)
-
-        Focus on:
-        - Changes that affect developers using Meilisearch
-        - Technical improvements and new capabilities
-        - SDK updates and API changes
+        analysis_requests = {}
+        for custom_id, year in job_ids.items():
+            repos, releases_by_repo = self.collect_releases('meilisearch', year)
+            releases = [release for repo in repos for release in releases_by_repo.get(repo['full_name'], [])]
+            print(f"- {year}: {len(releases)} releases")
+            if not releases:
+                print(f"Warning: No {year} releases found, skipping that newsletter")
+                continue
+            analysis_requests[custom_id] = self._analysis_request(releases)
         
-        Avoid mentioning:
-        - Internal cloud platform changes
-        - Administrative or operational updates
-        - Changes that don't affect developers
-
-        Format the response in Markdown with:
-        - A clear technical subject line
-        - Preview text highlighting key improvements
-        - Proper headers (##) for each section
-        - Code examples where relevant
-        - Bullet points for features
-        - Bold and italic text for emphasis
+        print("Analyzing releases with a Claude message batch...")
+        analyses = self.run_message_batch(analysis_requests)
+        
+        print("Generating newsletters with a Claude message batch...")
+        newsletter_requests = {
+            custom_id: self._newsletter_request(analysis, job_ids[custom_id])
+            for custom_id, analysis in analyses.items()
+        }
+        newsletters = self.run_message_batch(newsletter_requests)
         
-        Analysis:
-        {analysis}
-        """
+        return {job_ids[custom_id]: newsletter for custom_id, newsletter in newsletters.items()}
+
+    def run_message_batch(self, requests_by_id: Dict[str, Dict]) -> Dict[str, str]:
+        """Submit a Message Batch, wait for it to end and return the text of each successful response"""
+        if not requests_by_id:
+            return {}
         
         try:
-            response = self.anthropic_client.beta.messages.create(
-                model="claude-3-sonnet-20240229",
-                max_tokens=1500,
-                temperature=0.7,
-                system="You are a Product Marketing expert for Meilisearch, skilled at communicating technical improvements to developers using our open-source search engine.",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
+            batch = self.anthropic_client.messages.batches.create(
+                requests=[
+                    {"custom_id": custom_id, "params": params}
+                    for custom_id, params in requests_by_id.items()
                 ]
             )
+            while batch.processing_status != "ended":
+                time.sleep(BATCH_POLL_INTERVAL)
+                batch = self.anthropic_client.messages.batches.retrieve(batch.id)
             
-            print(f"Newsletter response type: {type(response.content)}")
-            return response.content.text if hasattr(response.content, 'text') else str(response.content)
+            results = {}
+            for entry in self.anthropic_client.messages.batches.results(batch.id):
+                if entry.result.type == "succeeded":
+                    results[entry.custom_id] = self._response_text(entry.result.message)
+                else:
+                    print(f"Warning: Batch request {entry.custom_id} {entry.result.type}")
+            return results
             
         except Exception as e:
-            print(f"Error generating newsletter with Claude: {e}")
-            return ""
+            print(f"Error running Claude message batch: {e}")
+            return {}
 
-def main():
-    print("\n=== Starting Newsletter Generation Process ===\n")
+    def _response_text(self, message) -> str:
+        """Join the text blocks of a Claude message"""
+        return "".join(block.text for block in message.content if block.type == "text")
+
+    def _analysis_request(self, releases: List[Dict]) -> Dict:
+        """Build the Claude request parameters for the release analysis"""
+        # Take only the 10 most recent releases before doing any per-release work
+        recent_releases = sorted(releases, key=lambda r: r.get('published_at') or '', reverse=True)[:10]
+        
+        simplified_releases = []
+        for release in recent_releases:
+            simplified_release = {
+                'name': release.get('name', ''),
+                'tag_name': release.get('tag_name', ''),
+                'published_at': release.get('published_at', ''),
+                'body': self._truncate_release_notes(self._clean_release_notes(release.get('body') or '')),
+                'repository': release['repository']
+            }
+            simplified_releases.append(simplified_release)
+        
+        # orjson emits compact JSON: indentation is pure token overhead for Claude
+        releases_content = orjson.dumps(simplified_releases).decode()
+        
+        return dict(
+            model="claude-3-haiku-20240307",  # Structured summarization doesn't need Sonnet
+            max_tokens=1000,
+            temperature=0,
+            system=ANALYSIS_SYSTEM_PROMPT,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        # Static instructions go before the per-run content, with a single cache
+                        # breakpoint. It only takes effect once the prefix grows past Haiku's
+                        # 2048-token minimum; today's ~300 tokens are below it.
+                        {
+                            "type": "text",
+                            "text": ANALYSIS_INSTRUCTIONS,
+                            "cache_control": {"type": "ephemeral"}
+                        },
+                        {
+                            "type": "text",
+                            "text": f"Here are the releases to analyze:\n{releases_content}"
+                        }
+                    ]
+                }
+            ]
+        )
+
+    def _clean_release_notes(self, body: str) -> str:
+        """Strip images, HTML comments and redundant whitespace from release notes"""
+        body = body.replace('\r\n', '\n')
+        body = IMAGE_PATTERN.sub('', body)
+        body = HTML_COMMENT_PATTERN.sub('', body)
+        body = TRAILING_WHITESPACE_PATTERN.sub('', body)
+        body = BLANK_LINES_PATTERN.sub('\n\n', body)
+        return body.strip()
+
+    def _truncate_release_notes(self, body: str) -> str:
+        """Fit release notes into the token budget, cutting at section boundaries when possible"""
+        max_chars = RELEASE_NOTES_TOKEN_BUDGET * CHARS_PER_TOKEN
+        if len(body) <= max_chars:
+            return body
+        
+        # Keep whole "## " sections while they fit
+        sections = body.split('\n## ')
+        truncated = sections[0]
+        for section in sections[1:]:
+            candidate = f'{truncated}\n## {section}'
+            if len(candidate) > max_chars:
+                break
+            truncated = candidate
+        
+        # The first section alone is too long: cut at the last full line, unless that drops most of
+        # the budget (one long paragraph), in which case cut at the last word instead
+        if len(truncated) > max_chars:
+            hard_cut = truncated[:max_chars]
+            truncated = hard_cut.rsplit('\n', 1)[0]
+            if len(truncated) < max_chars // 2:
+                truncated = hard_cut.rsplit(' ', 1)[0]
+                if len(truncated) < max_chars // 2:
+                    truncated = hard_cut
+            # Close any code block left open by the cut
+            if truncated.count('```') % 2:
+                truncated += '\n```'
+        
+        return truncated
+
+    def _newsletter_request(self, analysis: str, year: int = 2024) -> Dict:
+        """Build the Claude request parameters for the newsletter"""
+        return dict(
+            model="claude-3-sonnet-20240229",
+            max_tokens=1500,
+            temperature=0.7,
+            system=NEWSLETTER_SYSTEM_PROMPT,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        # Same prefix layout as the analysis. claude-3-sonnet-20240229 does not
+                        # support prompt caching, so this breakpoint is inert until the model moves
+                        # to one that does and the prefix passes its 1024-token minimum.
+                        {
+                            "type": "text",
+                            "text": NEWSLETTER_INSTRUCTIONS.format(year=year),
+                            "cache_control": {"type": "ephemeral"}
+                        },
+                        {
+                            "type": "text",
+                            "text": f"Analysis:\n{analysis}"
+                        }
+                    ]
+                }
+            ]
+        )
+
+@functools.lru_cache(maxsize=1)
+def get_generator() -> NewsletterGenerator:
+    """Return the shared generator so its HTTP sessions and clients are created once"""
     generator = NewsletterGenerator()
+    atexit.register(generator.close)
+    return generator
+
+def run_batch(generator: NewsletterGenerator, years: List[int]):
+    """Generate one newsletter file per year using the Message Batches API"""
+    print(f"Collecting releases for {len(years)} years...")
+    newsletters = generator.generate_newsletters_batch(years)
+    for year, newsletter in newsletters.items():
+        output_file = f'meilisearch_newsletter_{year}.md'
+        print(f"Saving newsletter to {output_file}")
+        with open(output_file, 'w') as f:
+            f.write(newsletter)
+
+def main(years: Optional[List[int]] = None):
+    print("\n=== Starting Newsletter Generation Process ===\n")
+    generator = get_generator()
+    
+    if years:
+        run_batch(generator, years)
+        print("\n=== Newsletter Generation Process Completed ===")
+        return
     
     # Get most active repositories
     print("1. Fetching active Meilisearch repositories...")
-    repos = generator.get_active_repositories('meilisearch')
+    repos, releases_by_repo = generator.collect_releases('meilisearch')
     print(f"\nRepositories to analyze ({len(repos)}):")
     print("\nPriority repositories:")
     for repo in repos:
@@ -251,42 +662,41 @@ def main():
     # Collect all releases from 2024
     print("\n2. Collecting 2024 releases...")
     all_releases = []
+    repo_counts = {}
     for repo in repos:
-        releases = generator.get_releases(repo['full_name'])
+        releases = releases_by_repo.get(repo['full_name'], [])
         if releases:
             print(f"\nReleases from {repo['full_name']}:")
             for release in releases:
-                published_date = datetime.strptime(release['published_at'], '%Y-%m-%dT%H:%M:%SZ')
+                published_date = datetime.fromisoformat(release['published_at'].replace('Z', '+00:00'))
                 print(f"- {release['tag_name']} (Published: {published_date.strftime('%Y-%m-%d')})")
             all_releases.extend(releases)
+            repo_counts[repo['full_name']] = len(releases)
         else:
             print(f"\nNo 2024 releases found for {repo['full_name']}")
     
     print(f"\nTotal releases collected: {len(all_releases)}")
     print("\nSummary by repository:")
-    repo_counts = {}
-    for release in all_releases:
-        repo_name = release['url'].split('/repos/')[1].split('/releases')[0]
-        repo_counts[repo_name] = repo_counts.get(repo_name, 0) + 1
     for repo, count in repo_counts.items():
         print(f"- {repo}: {count} releases")
     
-    # Analyze releases
+    # Analyze releases. Each Claude call consumes the previous step's output, so the
+    # pipeline is sequential by design; only the GitHub fetches above run concurrently.
     print("\n3. Analyzing releases with Claude...")
     analysis = generator.analyze_releases(all_releases)
     print("\n4. Analysis completed")
     
-    # Generate newsletter
-    print("\n5. Generating newsletter content...")
-    newsletter = generator.generate_newsletter(analysis)
-    print("\n6. Newsletter generation completed")
-    
-    # Save the newsletter to a markdown file
+    # Generate the newsletter straight into the markdown file as it streams in
     output_file = 'meilisearch_newsletter_2024.md'
-    print(f"\n7. Saving newsletter to {output_file}")
-    with open(output_file, 'w') as f:
-        f.write(newsletter)
+    print(f"\n5. Generating newsletter content into {output_file}...")
+    with open(output_file, 'w', buffering=1) as f:
+        generator.generate_newsletter(analysis, output=f)
+    print("\n6. Newsletter generation completed")
     print("\n=== Newsletter Generation Process Completed ===")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    # Optional years to generate through the Message Batches API, e.g. 2023 2024
+    if not all(arg.isdigit() and len(arg) == 4 for arg in sys.argv[1:]):
+        print(f"Usage: python {os.path.basename(__file__)} [YEAR ...]")
+        sys.exit(2)
+    main([int(arg) for arg in sys.argv[1:]]) 
\ No newline at end of file